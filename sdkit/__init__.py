@@ -38,6 +38,25 @@ class Context(local):
 
         self.test_diffusers = False
 
+        self.full_half: bool = False
+        """
+        Experimental. If `True` (and `half_precision` is enabled), runs the entire model in float16,
+        without `torch.autocast`. This is faster than autocast, but models with numerically-fragile layers
+        may produce black images.
+        """
+
+        self.compile_models: bool = False
+        """
+        Experimental. Wraps the UNet and the VAE decoder in `torch.compile()` (requires PyTorch 2.0+ and a CUDA device).
+        The first image (and the first image after changing the width, height or number of outputs) will be slower,
+        while the model gets compiled.
+
+        Modules that are offloaded to the CPU aren't compiled: the UNet is skipped with `'KEEP_ENTIRE_MODEL_IN_CPU'`
+        (i.e. `vram_usage_level = 'low'`), and the VAE decoder is skipped with either of `'KEEP_FS_AND_CS_IN_CPU'`
+        or `'KEEP_ENTIRE_MODEL_IN_CPU'` (i.e. `'balanced'` or `'low'`). With diffusers, nothing is compiled at the
+        `'low'` level.
+        """
+
     # hacky approach, but we need to enforce full precision for some devices
     # we also need to force full precision for these devices (haven't implemented this yet):
     # (('nvidia' in device_name or 'geforce' in device_name) and (' 1660' in device_name or ' 1650' in device_name)) or ('Quadro T2000' in device_name)
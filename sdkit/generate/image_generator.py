@@ -1,15 +1,16 @@
+import os
+from collections import OrderedDict
 from contextlib import nullcontext
 
 import torch
-from pytorch_lightning import seed_everything
-from tqdm import trange
 
 from sdkit import Context
 from sdkit.utils import (
     apply_color_profile,
     base64_str_to_img,
     gc,
-    get_image_latent_and_mask,
+    get_image_posterior_and_mask,
+    img_to_resized_tensor,
     latent_samples_to_images,
     resize_img,
 )
@@ -45,77 +46,91 @@ def generate_images(
 ):
     req_args = locals()
 
-    try:
-        images = []
-
-        seed_everything(seed)
-        precision_scope = torch.autocast if context.half_precision else nullcontext
-
-        if "stable-diffusion" not in context.models:
-            raise RuntimeError(
-                "The model for Stable Diffusion has not been loaded yet! If you've tried to load it, please check the logs above this message for errors (while loading the model)."
-            )
+    full_half = context.half_precision and context.full_half
+    precision_scope = torch.autocast if context.half_precision and not full_half else nullcontext
 
-        model = context.models["stable-diffusion"]
-
-        if context.test_diffusers:
-            return make_with_diffusers(
-                context,
-                prompt,
-                negative_prompt,
-                seed,
-                width,
-                height,
-                num_outputs,
-                num_inference_steps,
-                guidance_scale,
-                init_image,
-                init_image_mask,
-                prompt_strength,
-                # preserve_init_image_color_profile,
-                sampler_name,
-                # hypernetwork_strength,
-                lora_alpha,
-                # sampler_params,
-                callback,
-            )
+    if "stable-diffusion" not in context.models:
+        raise RuntimeError(
+            "The model for Stable Diffusion has not been loaded yet! If you've tried to load it, please check the logs above this message for errors (while loading the model)."
+        )
 
-        if "hypernetwork" in context.models:
-            context.models["hypernetwork"]["hypernetwork_strength"] = hypernetwork_strength
+    model = context.models["stable-diffusion"]
 
-        with precision_scope("cuda"):
-            cond, uncond = get_cond_and_uncond(prompt, negative_prompt, num_outputs, model)
+    if context.test_diffusers:
+        return make_with_diffusers(
+            context,
+            prompt,
+            negative_prompt,
+            seed,
+            width,
+            height,
+            num_outputs,
+            num_inference_steps,
+            guidance_scale,
+            init_image,
+            init_image_mask,
+            prompt_strength,
+            # preserve_init_image_color_profile,
+            sampler_name,
+            # hypernetwork_strength,
+            lora_alpha,
+            # sampler_params,
+            callback,
+        )
 
-        generate_fn = txt2img if init_image is None else img2img
-        common_sampler_params = {
-            "context": context,
-            "sampler_name": sampler_name,
-            "seed": seed,
-            "batch_size": num_outputs,
-            "shape": [4, height // 8, width // 8],
-            "cond": cond,
-            "uncond": uncond,
-            "guidance_scale": guidance_scale,
-            "sampler_params": sampler_params,
-            "callback": callback,
-        }
+    # the diffusers path uses its own torch.Generator, so the global RNG only needs to be seeded here.
+    # torch.manual_seed() also seeds all the CUDA devices
+    torch.manual_seed(seed)
+
+    if "hypernetwork" in context.models:
+        context.models["hypernetwork"]["hypernetwork_strength"] = hypernetwork_strength
+
+    if full_half and not getattr(model, "_full_half_compatible", False):
+        from sdkit.models.model_loader.stable_diffusion.optimizations import make_full_half_precision_compatible
+
+        make_full_half_precision_compatible(model)  # the model is already in float16 (when loaded)
+        model._full_half_compatible = True
+
+    apply_channels_last(context, [model.model, model.first_stage_model], id(model))
+
+    # the CPU-offload hooks move the weights between devices, which doesn't work with the compiled graphs.
+    # the first stage model is offloaded by both the optimizations, the unet only by KEEP_ENTIRE_MODEL_IN_CPU
+    compile_key = (id(model), width, height, num_outputs)
+    if "KEEP_ENTIRE_MODEL_IN_CPU" not in context.vram_optimizations:
+        apply_torch_compile(context, [model.model], compile_key)
+    if not context.vram_optimizations.intersection({"KEEP_FS_AND_CS_IN_CPU", "KEEP_ENTIRE_MODEL_IN_CPU"}):
+        # the tiled decode collects the decoder outputs, so don't use CUDA graphs (which overwrite their outputs)
+        apply_torch_compile(context, [model.first_stage_model.decoder], compile_key, mode="max-autotune-no-cudagraphs")
+
+    with precision_scope("cuda"):
+        cond, uncond = get_cond_and_uncond(prompt, negative_prompt, num_outputs, model)
+
+    if full_half:
+        cond, uncond = cond.half(), uncond.half()
+
+    generate_fn = txt2img if init_image is None else img2img
+    common_sampler_params = {
+        "context": context,
+        "sampler_name": sampler_name,
+        "seed": seed,
+        "batch_size": num_outputs,
+        "shape": [4, height // 8, width // 8],
+        "cond": cond,
+        "uncond": uncond,
+        "guidance_scale": guidance_scale,
+        "sampler_params": sampler_params,
+        "callback": callback,
+    }
 
-        with torch.no_grad(), precision_scope("cuda"):
-            for _ in trange(1, desc="Sampling"):
-                images += generate_fn(common_sampler_params.copy(), **req_args)
-                gc(context)
+    with torch.no_grad(), precision_scope("cuda"):
+        images = generate_fn(common_sampler_params, **req_args)
+        gc(context)
 
-        return images
-    finally:
-        context.init_image_latent, context.init_image_mask_tensor = None, None
+    return images
 
 
 def txt2img(params: dict, context: Context, num_inference_steps, **kwargs):
-    params.update(
-        {
-            "steps": num_inference_steps,
-        }
-    )
+    params = {**params, "steps": num_inference_steps}
 
     samples = make_samples(**params)
     return latent_samples_to_images(context, samples)
@@ -134,33 +149,92 @@ def img2img(
     preserve_init_image_color_profile,
     **kwargs,
 ):
-    init_image = get_image(init_image)
-    init_image_mask = get_image(init_image_mask)
-
-    if not hasattr(context, "init_image_latent") or context.init_image_latent is None:
-        context.init_image_latent, context.init_image_mask_tensor = get_image_latent_and_mask(
-            context, init_image, init_image_mask, width, height, num_outputs
-        )
-
-    params.update(
-        {
-            "steps": num_inference_steps,
-            "init_image_latent": context.init_image_latent,
-            "mask": context.init_image_mask_tensor,
-            "prompt_strength": prompt_strength,
-        }
+    init_image_latent, init_image_mask_tensor = get_cached_image_latent_and_mask(
+        context, init_image, init_image_mask, width, height, num_outputs
     )
 
+    if context.half_precision and context.full_half:
+        init_image_latent = init_image_latent.half()
+        if init_image_mask_tensor is not None:
+            init_image_mask_tensor = init_image_mask_tensor.half()
+
+    params = {
+        **params,
+        "steps": num_inference_steps,
+        "init_image_latent": init_image_latent,
+        "mask": init_image_mask_tensor,
+        "prompt_strength": prompt_strength,
+    }
+
     samples = make_samples(**params)
     images = latent_samples_to_images(context, samples)
 
     if preserve_init_image_color_profile:
+        init_image = get_image(init_image, context)
         for i, img in enumerate(images):
             images[i] = apply_color_profile(init_image, img)
 
     return images
 
 
+def get_cached_image_latent_and_mask(
+    context: Context, init_image, init_image_mask, width, height, num_outputs, max_cache_size=4
+):
+    """
+    Returns the latent (and mask tensor) for the init image, re-using the VAE posterior from a previous call
+    (if available) for the same init image, mask, size and model.
+
+    This avoids running the VAE encoder again while iterating on the seed or the prompt with the same init image.
+    Only the posterior is cached, the latent is sampled from it on every call, so that it depends only on the seed.
+    """
+    if getattr(context, "_init_latent_cache", None) is None:
+        context._init_latent_cache = OrderedDict()
+
+    def image_key(img):
+        if isinstance(img, str):
+            # include the modification time for file paths, in case the file gets overwritten
+            return img if img.startswith("data:image") else (img, get_file_mtime(img))
+        return None if img is None else id(img)
+
+    def is_same_image(cached_img, img):
+        return cached_img == img if isinstance(img, str) else cached_img is img
+
+    cache = context._init_latent_cache
+    model = context.models["stable-diffusion"]
+    key = (
+        image_key(init_image),
+        image_key(init_image_mask),
+        width,
+        height,
+        num_outputs,
+        id(model),
+        context.model_paths.get("vae"),
+    )
+
+    entry = cache.get(key)
+    # the cache entry keeps a reference to the images, so an id() match is only valid for the same object
+    if entry is None or not is_same_image(entry[0], init_image) or not is_same_image(entry[1], init_image_mask):
+        posterior, mask_tensor = get_image_posterior_and_mask(
+            context, get_image(init_image, context), get_image(init_image_mask, context), width, height, num_outputs
+        )
+        entry = (init_image, init_image_mask, posterior, mask_tensor)
+        cache[key] = entry
+
+    cache.move_to_end(key)
+    if len(cache) > max_cache_size:
+        cache.popitem(last=False)
+
+    posterior, mask_tensor = entry[2], entry[3]
+    if posterior is None:
+        return None, None
+
+    latent = model.get_first_stage_encoding(posterior)  # samples from the posterior, using the seeded RNG
+    if "cuda" in context.device:
+        latent = latent.contiguous(memory_format=torch.channels_last)
+
+    return latent, mask_tensor
+
+
 def make_with_diffusers(
     context: Context,
     prompt: str = "",
@@ -208,11 +282,18 @@ def make_with_diffusers(
         "num_images_per_prompt": num_outputs,
     }
     if init_image:
-        cmd["image"] = get_image(init_image).convert("RGB")
-        cmd["image"] = resize_img(cmd["image"], width, height, clamp_to_64=True)
+        # img2img accepts a [-1, 1] tensor, so resize on the GPU. the inpainting pipelines require the image and
+        # the mask to be of the same type, and the mask layout differs per pipeline, so keep PIL images for those
+        if "cuda" in context.device and not init_image_mask:
+            cmd["image"] = img_to_resized_tensor(
+                get_image(init_image, context), width, height, context.device, clamp_to_64=True
+            )
+        else:
+            cmd["image"] = get_image(init_image, context).convert("RGB")
+            cmd["image"] = resize_img(cmd["image"], width, height, clamp_to_64=True)
         cmd["strength"] = prompt_strength
     if init_image_mask:
-        cmd["mask_image"] = get_image(init_image_mask).convert("RGB")
+        cmd["mask_image"] = get_image(init_image_mask, context).convert("RGB")
         cmd["mask_image"] = resize_img(cmd["mask_image"], width, height, clamp_to_64=True)
 
     if init_image:
@@ -234,8 +315,19 @@ def make_with_diffusers(
     if diffusers_samplers.samplers.get(sampler_name) is None:
         raise NotImplementedError(f"The sampler '{sampler_name}' is not supported (yet)!")
 
-    operation_to_apply.scheduler = diffusers_samplers.samplers[sampler_name]
-    log.info(f"Using sampler: {operation_to_apply.scheduler} because of {sampler_name}")
+    if context.vram_usage_level != "low":  # sequential cpu offload moves the weights around
+        apply_channels_last(context, [operation_to_apply.unet, operation_to_apply.vae], id(operation_to_apply.unet))
+        compile_key = (id(operation_to_apply), width, height, num_outputs)
+        apply_torch_compile(context, [operation_to_apply.unet], compile_key)
+        # the sliced and tiled VAE decodes collect the decoder outputs, so don't use CUDA graphs for the decoder.
+        # the text encoder isn't compiled, since compel keeps the outputs of consecutive text encoder calls
+        apply_torch_compile(context, [operation_to_apply.vae.decoder], compile_key, mode="max-autotune-no-cudagraphs")
+
+    # the schedulers are made once (when the model is loaded), so only swap them when the sampler changes
+    scheduler = diffusers_samplers.samplers[sampler_name]
+    if operation_to_apply.scheduler is not scheduler:
+        operation_to_apply.scheduler = scheduler
+        log.info(f"Using sampler: {scheduler} because of {sampler_name}")
 
     if isinstance(operation_to_apply, StableDiffusionInpaintPipelineLegacy) or isinstance(
         operation_to_apply, StableDiffusionImg2ImgPipeline
@@ -247,8 +339,8 @@ def make_with_diffusers(
 
     cmd["callback"] = lambda i, t, x_samples: callback(x_samples, i, operation_to_apply) if callback else None
 
-    # apply the LoRA (if necessary)
-    if context.models.get("lora"):
+    # apply the LoRA (if necessary). skip if the same alpha is already applied to the weights
+    if context.models.get("lora") and getattr(context, "_last_lora_alpha", None) != lora_alpha:
         log.info("Applying LoRA..")
         if hasattr(context, "_last_lora_alpha"):
             apply_lora_model(context, -context._last_lora_alpha)  # undo the last LoRA apply
@@ -261,26 +353,12 @@ def make_with_diffusers(
     # make the prompt embeds
     compel = model["compel"]
 
-    # temporary hack until compel 1.1.4 is released
-    if hasattr(operation_to_apply.text_encoder, "_hf_hook"):
-        [m._hf_hook.pre_forward(m) for m in operation_to_apply.text_encoder.modules() if hasattr(m, "_hf_hook")]
-        print(compel.device)
-
     log.info("compel is ready")
-    cmd["prompt_embeds"] = compel(prompt)
-
-    if hasattr(operation_to_apply.text_encoder, "_hf_hook"):
-        [m._hf_hook.pre_forward(m) for m in operation_to_apply.text_encoder.modules() if hasattr(m, "_hf_hook")]
-        print(compel.device)
+    cmd["prompt_embeds"], cmd["negative_prompt_embeds"] = get_prompt_embeds(
+        context, compel, operation_to_apply.text_encoder, [prompt, negative_prompt]
+    )
 
     log.info("Made prompt embeds")
-    cmd["negative_prompt_embeds"] = compel(negative_prompt)
-
-    if hasattr(operation_to_apply.text_encoder, "_hf_hook"):
-        [m._hf_hook.pre_forward(m) for m in operation_to_apply.text_encoder.modules() if hasattr(m, "_hf_hook")]
-        print(compel.device)
-
-    log.info("Made negative prompt embeds")
     cmd["prompt_embeds"], cmd["negative_prompt_embeds"] = compel.pad_conditioning_tensors_to_same_length(
         [cmd["prompt_embeds"], cmd["negative_prompt_embeds"]]
     )
@@ -294,16 +372,130 @@ def make_with_diffusers(
     return operation_to_apply(**cmd).images
 
 
-def get_image(img):
+def get_prompt_embeds(context: Context, compel, text_encoder, prompts: list, max_cache_size=32):
+    """
+    Returns the compel embeddings for the prompts, re-using previous embeddings (if available)
+    for the same model and LoRA.
+
+    The embeddings are kept in a small LRU cache on the context, to avoid running the text encoder again
+    while iterating on the seed or the number of steps with the same prompt.
+    """
+    if getattr(context, "_prompt_embed_cache", None) is None:
+        context._prompt_embed_cache = OrderedDict()
+
+    cache = context._prompt_embed_cache
+    # the cache is cleared when a LoRA is loaded or unloaded
+    keys = [(id(compel), getattr(context, "_last_lora_alpha", None), p) for p in prompts]
+
+    for prompt, key in zip(prompts, keys):
+        if key not in cache:
+            # temporary hack until compel 1.1.4 is released. with sequential cpu offload, accelerate moves
+            # the weights back to the 'meta' device after every forward, and compel reads `text_encoder.device`
+            if hasattr(text_encoder, "_hf_hook"):
+                [m._hf_hook.pre_forward(m) for m in text_encoder.modules() if hasattr(m, "_hf_hook")]
+
+            with torch.no_grad():
+                cache[key] = compel(prompt)
+
+    result = [cache[key] for key in keys]
+
+    for key in keys:
+        cache.move_to_end(key)
+    while len(cache) > max_cache_size:
+        cache.popitem(last=False)
+
+    return result
+
+
+def apply_channels_last(context: Context, modules: list, model_id: int):
+    """
+    Converts the modules to the channels-last memory format (once per model), so that cuDNN can use
+    its NHWC convolution kernels directly, instead of transposing the tensors for each convolution.
+    """
+    if "cuda" not in context.device or getattr(context, "_channels_last", None) == model_id:
+        return
+
+    for module in modules:
+        module.to(memory_format=torch.channels_last)
+
+    context._channels_last = model_id
+
+
+def apply_torch_compile(context: Context, modules: list, cache_key: tuple, mode="reduce-overhead"):
+    """
+    Replaces the `forward()` of each module with a `torch.compile()`-d version, if `context.compile_models` is set.
+
+    The compiled modules are re-wrapped only if `cache_key` changes (e.g. a different model, or a different
+    width/height/num_outputs), since the graphs are compiled for static shapes.
+
+    The default mode ("reduce-overhead") uses CUDA graphs, which overwrite the outputs of the previous call.
+    So use a different mode (e.g. "max-autotune-no-cudagraphs") for modules whose outputs are kept across calls.
+    """
+    if not context.compile_models or not context.device.startswith("cuda") or not hasattr(torch, "compile"):
+        return
+
+    modules = [m for m in modules if getattr(m, "_compile_key", None) != cache_key]
+    if not modules:
+        return
+
+    from sdkit.utils import log
+
+    log.info(f"Compiling the model for {cache_key[1:]}. The first image will take longer..")
+
+    for module in modules:
+        if not hasattr(module, "_uncompiled_forward"):
+            module._uncompiled_forward = module.forward
+
+        # not using fullgraph=True, since the sliced attention implementation (and the VRAM-saving hooks)
+        # can cause graph breaks
+        module.forward = torch.compile(module._uncompiled_forward, mode=mode, dynamic=False)
+        module._compile_key = cache_key
+
+
+def get_file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_image(img, context: Context = None, max_cache_size=4):
+    """
+    Returns the PIL image for a path, a base64 data URI, or an image. If a context is given, the images
+    loaded from file paths are cached on the context (by path and modification time), to avoid decoding
+    the same init image on every call. Each call gets its own copy of the cached image.
+    """
     if not isinstance(img, str):
         return img
 
     if img.startswith("data:image"):
         return base64_str_to_img(img)
 
-    import os
+    mtime = get_file_mtime(img)
+    if mtime is None:
+        return None
+
+    if context is None:
+        return _open_image_file(img)
+
+    if getattr(context, "_image_file_cache", None) is None:
+        context._image_file_cache = OrderedDict()
+
+    cache = context._image_file_cache
+    key = (img, mtime)
+    if key not in cache:
+        cache[key] = _open_image_file(img)
+
+    cache.move_to_end(key)
+    if len(cache) > max_cache_size:
+        cache.popitem(last=False)
+
+    return cache[key].copy()
+
 
-    if os.path.exists(img):
-        from PIL import Image
+def _open_image_file(path):
+    from PIL import Image
 
-        return Image.open(img)
+    img = Image.open(path)
+    img.load()
+    return img
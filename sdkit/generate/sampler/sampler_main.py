@@ -51,6 +51,8 @@ def make_samples(
         raise RuntimeError(f'Unknown sampler "{sampler_name}"!')
 
     noise = make_some_noise(seed, batch_size, shape, context.device)
+    if context.half_precision and context.full_half:
+        noise = noise.half()
 
     return sampler_module.sample(
         context, sampler_name, noise, batch_size, shape, steps, cond, uncond, guidance_scale, callback, **kwargs
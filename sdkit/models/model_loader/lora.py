@@ -7,6 +7,7 @@ from sdkit.utils import load_tensor_file, log
 
 
 def load_model(context: Context, **kwargs):
+    context._prompt_embed_cache = None  # the LoRA changes the text encoder weights
     lora_model_path = context.model_paths.get("lora")
     return load_tensor_file(lora_model_path)
 
@@ -16,6 +17,7 @@ def move_model_to_cpu(context: Context):
 
 
 def unload_model(context: Context, **kwargs):
+    context._prompt_embed_cache = None
     if hasattr(context, "_last_lora_alpha"):
         removal_alpha = -1 * context._last_lora_alpha
         del context._last_lora_alpha
@@ -110,6 +110,9 @@ def load_model(context: Context, scan_model=True, check_for_config_with_same_nam
 
 def unload_model(context: Context, **kwargs):
     context.module_in_gpu = None  # don't keep a dangling reference, prevents gc
+    context._prompt_embed_cache = None  # the cached prompt embeddings belong to the unloaded model
+    context._init_latent_cache = None
+    context._image_file_cache = None
 
 
 def load_diffusers_model(context: Context, model_path, config_file_path):
@@ -126,6 +129,7 @@ def load_diffusers_model(context: Context, model_path, config_file_path):
 
     from .convert_from_ckpt import download_from_original_stable_diffusion_ckpt
 
+    from . import optimizations
     from .optimizations import optimized_get_attention_scores
 
     from diffusers.models.attention_processor import Attention
@@ -169,7 +173,12 @@ def load_diffusers_model(context: Context, model_path, config_file_path):
         else:
             default_pipe = default_pipe.to(context.device)
 
-    if context.vram_usage_level != "high":
+    if optimizations.is_sdpa_available(context) and attn_precision != "fp32":  # AttnProcessor2_0 doesn't upcast
+        from diffusers.models.attention_processor import AttnProcessor2_0
+
+        # the fused attention kernels don't need attention slicing to save VRAM
+        default_pipe.unet.set_attn_processor(AttnProcessor2_0())
+    elif context.vram_usage_level != "high":
         default_pipe.enable_attention_slicing(1)
 
     try:
@@ -182,6 +191,9 @@ def load_diffusers_model(context: Context, model_path, config_file_path):
     if torch.__version__.startswith("2."):
         default_pipe.enable_vae_slicing()
 
+    if hasattr(default_pipe.vae, "enable_tiling"):
+        default_pipe.vae.enable_tiling()  # only applies to images larger than the VAE's tile size
+
     # make the compel prompt parser object
     compel = Compel(
         tokenizer=default_pipe.tokenizer,
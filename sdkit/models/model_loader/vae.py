@@ -17,7 +17,7 @@ def load_model(context: Context, **kwargs):
     vae_model_path = context.model_paths.get("vae")
 
     try:
-        vae = load_tensor_file(vae_model_path)
+        vae = load_tensor_file(vae_model_path, device=_get_vae_device(context))
         vae = vae["state_dict"]
 
         if context.test_diffusers:
@@ -82,4 +82,16 @@ def _set_vae(context: Context, vae: dict):
 
 def _get_base_model_vae(context: Context):
     base_vae = os.path.join(tempfile.gettempdir(), "sd-base-vae.safetensors")
-    return load_tensor_file(base_vae)
+    return load_tensor_file(base_vae, device=_get_vae_device(context))
+
+
+def _get_vae_device(context: Context):
+    "Returns the device of the loaded VAE, so that the state_dict can be loaded directly on that device"
+    if "stable-diffusion" not in context.models:
+        return "cpu"
+
+    model = context.models["stable-diffusion"]
+    vae = model["default"].vae if context.test_diffusers else model.first_stage_model
+    device = next(vae.parameters()).device
+
+    return device if device.type == "cuda" else "cpu"  # e.g. "meta", if offloaded by accelerate
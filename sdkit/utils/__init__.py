@@ -19,6 +19,8 @@ from .image_utils import (
 )
 from .latent_utils import (
     get_image_latent_and_mask,
+    get_image_posterior_and_mask,
+    img_to_resized_tensor,
     img_to_tensor,
     latent_samples_to_images,
     diffusers_latent_samples_to_images,
@@ -1,28 +1,69 @@
 import json
 import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import piexif
 import piexif.helper
 import safetensors.torch
 import torch
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
-def load_tensor_file(path):
+
+def load_tensor_file(path, device="cpu"):
+    """
+    Loads a `.safetensors` or a pickled torch file directly onto `device` (the CPU by default).
+    Loading directly onto the GPU avoids keeping an intermediate copy of each tensor in the CPU memory.
+    """
+    device = str(device)
     if path.lower().endswith(".safetensors"):
-        return safetensors.torch.load_file(path, device="cpu")
+        return safetensors.torch.load_file(path, device=device)
     else:
-        return torch.load(path, map_location="cpu")
+        return torch.load(path, map_location=device)
 
 
 def save_tensor_file(data, path):
     if path.lower().endswith(".safetensors"):
-        return safetensors.torch.save_file(data, path, metadata={"format": "pt"})
+        return safetensors.torch.save_file(_to_cpu_tensors(data), path, metadata=_get_safetensors_metadata())
     else:
         return torch.save(data, path)
 
 
+def _to_cpu_tensors(data: dict):
+    """
+    Copies the GPU tensors to the CPU once, before serializing.
+    A non-blocking copy to the CPU goes into pinned memory, so all the copies are queued together,
+    and waited for with a single synchronize per source device (instead of one blocking copy per tensor).
+    """
+    cpu_data = {}
+    cuda_devices = set()
+    for key, tensor in data.items():
+        if isinstance(tensor, torch.Tensor) and tensor.device.type == "cuda":
+            cuda_devices.add(tensor.device)
+            tensor = tensor.detach().contiguous().to("cpu", non_blocking=True)
+        cpu_data[key] = tensor
+
+    # synchronize() without a device only waits on the current device, which needn't be the tensor's device
+    for device in cuda_devices:
+        torch.cuda.synchronize(device)
+
+    return cpu_data
+
+
+def _get_safetensors_metadata():
+    from importlib.metadata import PackageNotFoundError, version
+
+    metadata = {"format": "pt"}
+    try:
+        metadata["sdkit_version"] = version("sdkit")
+    except PackageNotFoundError:
+        pass
+
+    return metadata
+
+
 def save_images(
     images: list,
     dir_path: str,
@@ -46,12 +87,22 @@ def save_images(
         return
     os.makedirs(dir_path, exist_ok=True)
 
-    for i, img in enumerate(images):
+    output_lossless = output_lossless and output_format.lower() == "webp"
+
+    def save_image(i, img):
         actual_file_name = file_name(i) if callable(file_name) else f"{file_name}_{i}"
         path = os.path.join(dir_path, actual_file_name)
-        output_lossless = output_lossless and output_format.lower() == "webp"
         img.save(f"{path}.{output_format.lower()}", quality=output_quality, lossless=output_lossless)
 
+    if len(images) <= 1:
+        for i, img in enumerate(images):
+            save_image(i, img)
+        return
+
+    # PIL releases the GIL while encoding, so the images can be encoded and written in parallel
+    with ThreadPoolExecutor(max_workers=min(8, len(images))) as executor:
+        list(executor.map(save_image, range(len(images)), images))
+
 
 def save_dicts(entries: list, dir_path: str, file_name="data", output_format="txt", file_format=""):
     """
@@ -61,37 +112,93 @@ def save_dicts(entries: list, dir_path: str, file_name="data", output_format="tx
         if a string, the actual file name will be `{file_name}_{index}`.
         if a function, the callback function will be passed the `index` (int),
           and the returned value will be used as the actual file name. e.g `def fn(i): return 'foo' + i`
-    * output_format: 'txt', 'json', or 'embed'
+    * output_format: 'txt', 'json', or 'embed', or a list of these (e.g. `['json', 'embed']`)
         if 'embed', the metadata will be embedded in PNG files in tEXt chunks, and as EXIF UserComment for JPEG and WEBP files
     """
     if dir_path is None:
         return
     os.makedirs(dir_path, exist_ok=True)
 
+    output_formats = [output_format.lower()] if isinstance(output_format, str) else [f.lower() for f in output_format]
+    file_format = file_format.lower()
+
     for i, metadata in enumerate(entries):
         actual_file_name = file_name(i) if callable(file_name) else f"{file_name}_{i}"
         path = os.path.join(dir_path, actual_file_name)
 
-        if output_format.lower() == "embed":
-            if file_format.lower() == "png":
-                targetImage = Image.open(f"{path}.{file_format.lower()}")
-                embedded_metadata = PngInfo()
-                for key, val in metadata.items():
-                    embedded_metadata.add_text(key, str(val))
-                targetImage.save(f"{path}.{file_format.lower()}", pnginfo=embedded_metadata)
-            else:
-                user_comment = json.dumps(metadata)
-                exif_dict = {
-                    "Exif": {
-                        piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(user_comment, encoding="unicode")
-                    }
-                }
-                exif_bytes = piexif.dump(exif_dict)
-                piexif.insert(exif_bytes, f"{path}.{file_format.lower()}")
-        else:
-            with open(f"{path}.{output_format.lower()}", "w", encoding="utf-8") as f:
-                if output_format.lower() == "txt":
+        for fmt in output_formats:
+            if fmt not in ("txt", "json"):
+                continue
+
+            with open(f"{path}.{fmt}", "w", encoding="utf-8") as f:
+                if fmt == "txt":
                     for key, val in metadata.items():
                         f.write(f"{key}: {val}\n")
-                elif output_format.lower() == "json":
+                else:
                     json.dump(metadata, f, indent=2)
+
+        if "embed" not in output_formats:
+            continue
+
+        if file_format == "png":
+            embed_png_text(f"{path}.{file_format}", metadata)
+        else:
+            user_comment = json.dumps(metadata)
+            exif_dict = {
+                "Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(user_comment, encoding="unicode")}
+            }
+            exif_bytes = piexif.dump(exif_dict)
+            piexif.insert(exif_bytes, f"{path}.{file_format}")
+
+
+def embed_png_text(path: str, metadata: dict):
+    """
+    Adds the metadata to an existing PNG file as tEXt chunks (or iTXt, for non-latin-1 text), by inserting
+    the chunks before the first IDAT chunk. This avoids decoding and re-encoding the image just to add the metadata.
+    The chunks need to be before IDAT, since PIL only reads text chunks after IDAT once the image is loaded.
+    Existing text chunks with the same keys are replaced.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError(f"Not a PNG file: {path}")
+
+    keys = {key.encode("latin-1") for key in metadata.keys()}
+    chunks = []
+    idat_index = None
+    pos = 8
+    while pos < len(data):
+        length = struct.unpack(">I", data[pos : pos + 4])[0]
+        chunk_type = data[pos + 4 : pos + 8]
+        chunk_end = pos + 12 + length
+        if chunk_type in (b"tEXt", b"iTXt", b"zTXt") and data[pos + 8 : chunk_end - 4].split(b"\0", 1)[0] in keys:
+            pos = chunk_end
+            continue
+        if chunk_type == b"IDAT" and idat_index is None:
+            idat_index = len(chunks)
+        chunks.append(data[pos:chunk_end])
+        pos = chunk_end
+        if chunk_type == b"IEND":
+            break
+
+    text_chunks = []
+    for key, val in metadata.items():
+        key, val = key.encode("latin-1"), str(val)
+        try:
+            text_chunks.append(_make_png_chunk(b"tEXt", key + b"\0" + val.encode("latin-1")))
+        except UnicodeEncodeError:
+            text_chunks.append(_make_png_chunk(b"iTXt", key + b"\0\0\0\0\0" + val.encode("utf-8")))
+
+    if idat_index is None:
+        raise ValueError(f"No image data in the PNG file: {path}")
+    chunks[idat_index:idat_index] = text_chunks
+
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(b"".join(chunks))
+
+
+def _make_png_chunk(chunk_type: bytes, chunk_data: bytes):
+    crc = zlib.crc32(chunk_type + chunk_data) & 0xFFFFFFFF
+    return struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data + struct.pack(">I", crc)
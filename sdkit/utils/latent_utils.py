@@ -46,8 +46,45 @@ def img_to_tensor(img: Image, batch_size, device, half_precision: bool, shift_ra
     return img
 
 
+def img_to_resized_tensor(img: Image, desired_width, desired_height, device, clamp_to_64=False):
+    """
+    Returns the image as a `[1, 3, H, W]` tensor (in the range [-1, 1]) on the device, resized on the device
+    (bicubic, antialiased) instead of resizing the PIL image on the CPU.
+    """
+    w, h = desired_width, desired_height
+    if clamp_to_64:
+        w, h = map(lambda x: x - x % 64, (w, h))  # resize to integer multiple of 64
+
+    img = torch.from_numpy(np.array(img.convert("RGB")))
+    if "cuda" in str(device):
+        img = img.pin_memory()
+    img = img.to(device, non_blocking=True)
+
+    img = img.permute(2, 0, 1).unsqueeze(0).float() / 255.0
+    img = torch.nn.functional.interpolate(img, size=(h, w), mode="bicubic", antialias=True, align_corners=False)
+
+    return 2.0 * img.clamp(0.0, 1.0) - 1.0
+
+
 def get_image_latent_and_mask(context: Context, image: Image, mask: Image, desired_width, desired_height, batch_size):
     """
+    Assumes model is on the correct device
+    """
+    posterior, mask = get_image_posterior_and_mask(context, image, mask, desired_width, desired_height, batch_size)
+    if posterior is None:
+        return None, None
+
+    model = context.models["stable-diffusion"]
+    image = model.get_first_stage_encoding(posterior)  # move to latent space (samples from the posterior)
+
+    return image, mask
+
+
+def get_image_posterior_and_mask(context: Context, image: Image, mask: Image, desired_width, desired_height, batch_size):
+    """
+    Returns the VAE posterior (before sampling) and the mask tensor for the image. Unlike the latent,
+    both of these are deterministic, i.e. they don't depend on the seed.
+
     Assumes model is on the correct device
     """
     from .image_utils import resize_img
@@ -60,17 +97,19 @@ def get_image_latent_and_mask(context: Context, image: Image, mask: Image, desir
     image = image.convert("RGB")
     image = resize_img(image, desired_width, desired_height, clamp_to_64=True)
     image = img_to_tensor(image, batch_size, context.device, context.half_precision, shift_range=True)
-    image = model.get_first_stage_encoding(model.encode_first_stage(image))  # move to latent space
+    posterior = model.encode_first_stage(image)
 
     if mask is None:
-        return image, None
+        return posterior, None
+
+    latent_height, latent_width = image.shape[2] // 8, image.shape[3] // 8
 
     mask = mask.convert("RGB")
-    mask = resize_img(mask, image.shape[3], image.shape[2])
+    mask = resize_img(mask, latent_width, latent_height)
     mask = ImageOps.invert(mask)
     mask = img_to_tensor(mask, batch_size, context.device, context.half_precision, unsqueeze=True)
 
-    return image, mask
+    return posterior, mask
 
 
 def latent_samples_to_images(context: Context, samples):
@@ -79,7 +118,10 @@ def latent_samples_to_images(context: Context, samples):
     if context.half_precision and samples.dtype != torch.float16:
         samples = samples.half()
 
-    samples = model.decode_first_stage(samples)
+    if samples.shape[2] * samples.shape[3] > (768 // 8) * (768 // 8):
+        samples = decode_first_stage_tiled(model, samples)
+    else:
+        samples = model.decode_first_stage(samples)
     samples = torch.clamp((samples + 1.0) / 2.0, min=0.0, max=1.0)
 
     images = []
@@ -91,6 +133,50 @@ def latent_samples_to_images(context: Context, samples):
     return images
 
 
+def decode_first_stage_tiled(model, samples, tile_size=64, tile_overlap=8):
+    """
+    Decodes the latent in overlapping tiles (of `tile_size` in latent space, i.e. 512px with 64px overlap),
+    and blends the decoded tiles using gaussian weights. The peak VRAM usage depends on the tile size,
+    instead of the image size.
+    """
+
+    def get_tile_starts(size):
+        if size <= tile_size:
+            return [0]
+        starts = list(range(0, size - tile_size + 1, tile_size - tile_overlap))
+        if starts[-1] + tile_size < size:
+            starts.append(size - tile_size)
+        return starts
+
+    def gaussian_weights(height, width, device):
+        def gaussian(n):
+            x = torch.arange(n, device=device, dtype=torch.float32)
+            return torch.exp(-(((x - (n - 1) / 2) / (n / 4)) ** 2) / 2)
+
+        return torch.outer(gaussian(height), gaussian(width))
+
+    _, _, h, w = samples.shape
+    result, weights = None, None
+
+    for y in get_tile_starts(h):
+        for x in get_tile_starts(w):
+            tile = model.decode_first_stage(samples[:, :, y : y + tile_size, x : x + tile_size]).float()
+            tile_h, tile_w = tile.shape[2], tile.shape[3]
+            scale = tile_h // min(tile_size, h)  # the VAE upscales the latent by 8x
+
+            if result is None:
+                result = torch.zeros((tile.shape[0], tile.shape[1], h * scale, w * scale), device=tile.device)
+                weights = torch.zeros((h * scale, w * scale), device=tile.device)
+
+            tile_weights = gaussian_weights(tile_h, tile_w, tile.device)
+            y_px, x_px = y * scale, x * scale
+            result[:, :, y_px : y_px + tile_h, x_px : x_px + tile_w] += tile * tile_weights
+            weights[y_px : y_px + tile_h, x_px : x_px + tile_w] += tile_weights
+            del tile
+
+    return result / weights
+
+
 @torch.no_grad()
 def diffusers_latent_samples_to_images(context: Context, samples):
     samples, model = samples